@@ -3,96 +3,244 @@ import yfinance as yf
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from sar import _sar_core, _sar_extend
 from datetime import datetime, timedelta
 
 # --- 1. 狀態初始化與配置 ---
 if "submitted" not in st.session_state:
     st.session_state.submitted = False
+if "sar_cache" not in st.session_state:
+    st.session_state.sar_cache = None  # 只保留最近一次的計算結果
 
 st.set_page_config(
     page_title="改良版 SAR 分析工具", 
     layout="wide",
-    initial_sidebar_state="collapsed" if st.session_state.submitted else "expanded"
+    initial_sidebar_state="auto"  # 固定值，不隨狀態重新設定頁面 (使用者收合側欄的狀態 Streamlit 會自行保留)
 )
 
 # --- 2. 改良版 SAR 核心演算法 (邏輯不變，確保有抓取 High/Low) ---
-def calculate_modified_sar(df, af_start=0.02, af_limit=0.2):
-    # 這裡明確抓取 High, Low, Close 進行運算
-    high = df['High'].values.flatten()
-    low = df['Low'].values.flatten()
-    close = df['Close'].values.flatten()
+def calculate_modified_sar(df, af_start=0.02, af_limit=0.2, prev=None):
+    # prev: 先前對 df 前段算過的 (sar, trend, 尾端狀態)，有給就只算後面新增的 K 線
+    # 這裡明確抓取 High, Low, Close 進行運算 (轉成連續 float64 陣列給 Numba)
+    # 維持 float64 (未改用 float32)：對已捨入到跳動單位的價格兩者結果相同 (相對誤差約 1e-7)，
+    # 但只差 float64 捨入雜訊的價格 (如 15.95 與 15.950000000000001) 在 float32 會變成相等，
+    # 「創新高/新低才更新 EP 與 AF」的判斷隨之改變；幾百根 K 線的頻寬節省不值得這個差異
+    arr = df[['High', 'Low', 'Close']].to_numpy(dtype=np.float64, copy=False)
+    high = np.ascontiguousarray(arr[:, 0])
+    low = np.ascontiguousarray(arr[:, 1])
+    close = np.ascontiguousarray(arr[:, 2])
     size = len(df)
     
-    sar = np.zeros(size)
-    trend = np.ones(size)  # 1: 上升, -1: 下降
-    af = np.full(size, af_start)
-    ep = np.zeros(size)
-
-    # 初始值設定
-    trend[0] = 1 if close[min(1, size-1)] > close[0] else -1
-    sar[0] = low[0] if trend[0] == 1 else high[0]
-    ep[0] = high[0] if trend[0] == 1 else low[0]
-
-    for i in range(1, size):
-        prev_sar = sar[i-1]
-        prev_trend = trend[i-1]
-        prev_af = af[i-1]
-        prev_ep = ep[i-1]
-
-        # 基礎 SAR 計算
-        current_sar = prev_sar + prev_af * (prev_ep - prev_sar)
-        
-        new_trend = prev_trend
-        new_af = prev_af
-        new_ep = prev_ep
-
-        if prev_trend == 1:  # 上升趨勢
-            if low[i] <= current_sar: # 判斷最低價是否觸碰
-                if close[i] > current_sar:
-                    # 改良點：觸碰但收盤有守住 -> Reset AF
-                    new_af = af_start
-                else:
-                    # 實體跌破 -> 反轉
-                    new_trend = -1
-                    current_sar = prev_ep
-                    new_af = af_start
-                    new_ep = low[i]
-        else:  # 下降趨勢
-            if high[i] >= current_sar: # 判斷最高價是否觸碰
-                if close[i] < current_sar:
-                    # 改良點：觸碰但收盤沒過 -> Reset AF
-                    new_af = af_start
-                else:
-                    # 實體突破 -> 反轉
-                    new_trend = 1
-                    current_sar = prev_ep
-                    new_af = af_start
-                    new_ep = high[i]
-
-        # 更新極值 (EP) 與 AF
-        if new_trend == 1:
-            if high[i] > new_ep:
-                new_ep = high[i]
-                new_af = min(af_limit, new_af + af_start)
+    sar = np.empty(size)
+    trend = np.empty(size, dtype=np.int8)  # 1: 上升, -1: 下降
+
+    # 初始趨勢要看第二根 K 線，所以前段至少要有兩根才能接著算
+    if prev is not None and 2 <= len(prev[0]) <= size:
+        n = len(prev[0])
+        sar[:n] = prev[0]
+        trend[:n] = prev[1]
+        tail_state = _sar_extend(high[n:], low[n:], close[n:], sar[n:], trend[n:],
+                                 *prev[2], float(af_start), float(af_limit))
+    else:
+        tail_state = _sar_core(high, low, close, sar, trend, float(af_start), float(af_limit))
+
+    return sar, trend, tail_state
+
+# --- 增量計算 (結束日往後延時，只算新增的 K 線) ---
+def run_sar(df, base_id, start, af_start, af_limit):
+    key = (base_id, start, af_start, af_limit)
+    cached = st.session_state.sar_cache
+
+    prev = None
+    if cached is not None and cached['key'] == key:
+        n = len(cached['sar'])
+        # 舊資料必須是新資料的前段 (最後一根日期與價格都相同，避免除權息調整後誤用)
+        if n <= len(df) and df.index[n-1] == cached['last_date'] \
+                and np.array_equal(df[['High', 'Low', 'Close']].iloc[n-1].to_numpy(), cached['last_hlc']):
+            prev = (cached['sar'], cached['trend'], cached['tail_state'])
+
+    sar_values, trend_values, tail_state = calculate_modified_sar(df, af_start, af_limit, prev)
+    # 增量計算只需要最近一次的結果，換參數或股票時直接覆蓋，不累積
+    st.session_state.sar_cache = {
+        'key': key,
+        'sar': sar_values,
+        'trend': trend_values,
+        'tail_state': tail_state,
+        'last_date': df.index[-1],
+        'last_hlc': df[['High', 'Low', 'Close']].iloc[-1].to_numpy(),
+    }
+    return sar_values, trend_values
+
+# --- 資料下載 (記憶體快取一小時 + 硬碟快取一天，重啟後也不必重新向 Yahoo 下載) ---
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+CACHE_TTL = 86400
+
+def _prune_cache():
+    # 結束日預設是今天，每天都會產生新的快取檔；寫入時順便清掉過期的檔案 (含殘留的暫存檔)
+    now = time.time()
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) >= CACHE_TTL:
+                os.unlink(path)
+        except OSError:
+            pass  # 其他 session 可能已經刪掉
+
+def _download(ticker, start, end):
+    key = hashlib.md5(f"{ticker}|{start}|{end}".encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, f"{key}.pkl")
+    if os.path.exists(path):
+        if time.time() - os.path.getmtime(path) < CACHE_TTL:
+            try:
+                return pd.read_pickle(path)
+            except Exception:
+                pass  # 快取檔損毀就重新下載
         else:
-            if low[i] < new_ep:
-                new_ep = low[i]
-                new_af = min(af_limit, new_af + af_start)
+            try:
+                os.unlink(path)  # 過期就刪掉
+            except OSError:
+                pass
+
+    # 單一代號下載用不到 yfinance 的執行緒池
+    df = yf.download(ticker, start=start, end=end, progress=False,
+                     group_by='column', threads=False)
+    if not df.empty:
+        # 先寫暫存檔再 os.replace，多個 session 同時寫入也不會讀到半個檔案
+        # 寫入失敗 (唯讀或磁碟已滿) 只是少了快取，下載結果照常回傳
+        tmp_path = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            os.close(fd)
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+            _prune_cache()
+        except (OSError, pickle.PicklingError):
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+    return df
+
+# 用最近 5 天的少量資料探測哪個代號有效；都沒有近期資料就回傳 None
+# 查不到的結果只記 5 分鐘 (可能只是 Yahoo 暫時失敗)，短時間內重複分析同一代號不必再探測
+@st.cache_data(ttl=300, max_entries=512, show_spinner=False)
+def _probe_ticker(base_id):
+    for ticker in (base_id, f"{base_id}.TW", f"{base_id}.TWO"):
+        if not yf.download(ticker, period='5d', progress=False, threads=False).empty:
+            return ticker
+    return None
+
+# 代號對應 (上市 .TW / 上櫃 .TWO) 不會變，查到的結果長期記住，同一檔股票不必再試錯
+@st.cache_data(max_entries=512, show_spinner=False)
+def resolve_ticker(base_id):
+    ticker = _probe_ticker(base_id)
+    if ticker is None:
+        raise LookupError(base_id)  # 例外不會被快取，只有查到的代號會長期記住
+    return ticker
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_ohlc(base_id, start, end):
+    try:
+        tickers = [resolve_ticker(base_id)]
+    except LookupError:
+        # 近期沒有交易資料 (例如停牌)，改用原本的逐一嘗試 (只走這一輪)
+        tickers = [base_id, f"{base_id}.TW", f"{base_id}.TWO"]
 
-        sar[i] = current_sar
-        trend[i] = new_trend
-        af[i] = new_af
-        ep[i] = new_ep
+    for ticker in tickers:
+        df = _download(ticker, start, end)
+        if not df.empty:
+            break
+    else:
+        # 空結果也可能只是 Yahoo 暫時失敗或限流：用例外回報 (例外不會被快取)，下次點擊會重新下載
+        raise LookupError(base_id)
 
-    return sar, trend
+    # 確保欄位單純化 (去除 MultiIndex)
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = df.columns.get_level_values(0)
+    return df
+
+# --- 繪圖區 (修正假日空格問題；以資料內容為快取鍵，只調整介面時不必重建圖表) ---
+# 用 cache_resource 直接重用同一個 Figure 物件 (cache_data 每次命中都要 unpickle 並重新驗證整張圖)；
+# 之後沒有任何地方修改 fig，共用是安全的
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_fig(df, sar_values, trend_values, view_key):
+    fig = go.Figure()
+
+    # 價格只取到小數兩位再交給 Plotly，縮短傳到瀏覽器的 JSON
+    ohlc = np.round(df[['Open', 'High', 'Low', 'Close']].to_numpy(dtype=np.float64), 2)
+    sar_plot = np.round(sar_values, 2)
+
+    # 1. 繪製 Candlestick
+    fig.add_trace(go.Candlestick(
+        x=df.index,
+        open=ohlc[:, 0],
+        high=ohlc[:, 1],
+        low=ohlc[:, 2],
+        close=ohlc[:, 3],
+        name='K線',
+        increasing_line_color='#FF4B4B',
+        decreasing_line_color='#008000'
+    ))
+
+    # 2. SAR 點位 (多空合併成單一 trace，以逐點顏色區分：紅=多頭支撐、綠=空頭壓力)
+    colors = np.where(trend_values == 1, '#FF4B4B', '#008000')
+
+    fig.add_trace(go.Scatter(
+        x=df.index, y=sar_plot,
+        name='SAR', mode='markers',
+        marker=dict(color=colors.tolist(), size=4, symbol='circle')
+    ))
+
+    # 3. 計算並隱藏假日 (關鍵修改步驟)
+    # 週末直接用 bounds 規則跳過，只需列出平日的休市日
+    # 注意：座標軸有 rangebreaks 時 plotly.js 會隱藏 WebGL trace (Scattergl)，所以上面的點位必須用 go.Scatter
+    # 建立一個從「開始日」到「結束日」的平日日曆
+    dt_all = pd.bdate_range(start=df.index[0], end=df.index[-1])
+    # 找出「你的資料(df.index)」裡沒有的平日 -> 這些就是國定假日/休市日
+    dt_breaks = dt_all.difference(df.index).strftime("%Y-%m-%d").tolist()
+
+    fig.update_xaxes(
+        rangebreaks=[
+            dict(bounds=['sat', 'mon']),  # 隱藏週末
+            dict(values=dt_breaks)  # 隱藏這些日期
+        ]
+    )
+
+    # 優化圖表顯示
+    fig.update_layout(
+        xaxis_title=None, yaxis_title='價格',
+        xaxis_rangeslider_visible=False,
+        hovermode="x unified", 
+        template="plotly_white", 
+        height=600,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5),
+        uirevision=view_key  # 同一檔股票與區間才保留縮放/平移，換股票或日期時重設
+    )
+    return fig
 
 # --- 3. UI 介面 ---
-st.markdown("""
-    <style>
-    .main-title { font-size: 22px !important; font-weight: bold; margin-bottom: 5px; }
-    </style>
-    <div class="main-title">🚀 改良版 SAR 趨勢追蹤系統 (K線版)</div>
-    """, unsafe_allow_html=True)
+# 樣式與標題只產生一次，之後重新執行由快取重播
+@st.cache_resource
+def _inject_css():
+    st.markdown("""
+        <style>
+        .main-title { font-size: 22px !important; font-weight: bold; margin-bottom: 5px; }
+        </style>
+        <div class="main-title">🚀 改良版 SAR 趨勢追蹤系統 (K線版)</div>
+        """, unsafe_allow_html=True)
+
+_inject_css()
 
 st.sidebar.header("參數設定")
 stock_id = st.sidebar.text_input("股票代號", value="2330")
@@ -104,86 +252,26 @@ af_start = st.sidebar.slider("AF 起始值", 0.01, 0.1, 0.02, step=0.01)
 af_limit = st.sidebar.slider("AF 極限值", 0.1, 0.5, 0.2, step=0.05)
 
 if st.sidebar.button("開始分析", use_container_width=True):
-    st.session_state.submitted = True
-    st.rerun()
+    st.session_state.submitted = True  # 本次執行就會往下進入分析，不必再 st.rerun()
 
 # --- 4. 核心執行區 ---
 if st.session_state.submitted:
     with st.spinner('計算趨勢中...'):
         base_id = stock_id.strip().upper().replace(".TW", "").replace(".TWO", "")
-        df = yf.download(base_id, start=start_date, end=end_date, progress=False)
-        
-        # 簡易容錯重試
-        if df.empty:
-            df = yf.download(f"{base_id}.TW", start=start_date, end=end_date, progress=False)
-        if df.empty:
-            df = yf.download(f"{base_id}.TWO", start=start_date, end=end_date, progress=False)
-
-        if df.empty:
+        try:
+            df = load_ohlc(base_id, start_date, end_date)
+        except LookupError:
+            df = None
+
+        if df is None:
             st.error(f"❌ 找不到股票代號 '{base_id}'")
             st.session_state.submitted = False
         else:
-            # 確保欄位單純化 (去除 MultiIndex)
-            df.columns = [col[0] if isinstance(col, tuple) else col for col in df.columns]
-            
             # 執行計算
-            sar_values, trend_values = calculate_modified_sar(df, af_start, af_limit)
-            df['SAR'] = sar_values
-            df['Trend'] = trend_values
-            
-            # --- 繪圖區 (修正假日空格問題) ---
-            fig = go.Figure()
-
-            # 1. 繪製 Candlestick
-            fig.add_trace(go.Candlestick(
-                x=df.index,
-                open=df['Open'],
-                high=df['High'],
-                low=df['Low'],
-                close=df['Close'],
-                name='K線',
-                increasing_line_color='#FF4B4B',
-                decreasing_line_color='#008000'
-            ))
-
-            # 2. SAR 點位
-            up_trend = df[df['Trend'] == 1]
-            down_trend = df[df['Trend'] == -1]
-
-            fig.add_trace(go.Scatter(
-                x=up_trend.index, y=up_trend['SAR'],
-                name='多頭支撐', mode='markers',
-                marker=dict(color='#FF4B4B', size=4, symbol='circle')
-            ))
-
-            fig.add_trace(go.Scatter(
-                x=down_trend.index, y=down_trend['SAR'],
-                name='空頭壓力', mode='markers',
-                marker=dict(color='#008000', size=4, symbol='circle')
-            ))
-
-            # 3. 計算並隱藏假日 (關鍵修改步驟)
-            # 建立一個從「開始日」到「結束日」的完整日曆
-            dt_all = pd.date_range(start=df.index[0], end=df.index[-1])
-            # 找出「你的資料(df.index)」裡沒有的日期 -> 這些就是週末或假日
-            dt_breaks = dt_all.difference(df.index).strftime("%Y-%m-%d").tolist()
-
-            fig.update_xaxes(
-                rangebreaks=[
-                    dict(values=dt_breaks)  # 隱藏這些日期
-                ]
-            )
-
-            # 優化圖表顯示
-            fig.update_layout(
-                xaxis_title=None, yaxis_title='價格',
-                xaxis_rangeslider_visible=False,
-                hovermode="x unified", 
-                template="plotly_white", 
-                height=600,
-                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
-            )
+            sar_values, trend_values = run_sar(df, base_id, start_date, af_start, af_limit)
 
+            # SAR / 趨勢保持為獨立陣列，不插入 df 欄位 (避免 pandas 重新配置整塊資料)
+            fig = build_fig(df, sar_values, trend_values, f"{base_id}|{start_date}|{end_date}")
             st.plotly_chart(fig, use_container_width=True)
 
             # --- 數據摘要 ---
@@ -0,0 +1,90 @@
+# 改良版 SAR 的 Numba 核心。獨立成模組：Streamlit 每次重新執行 app.py 時，
+# 已匯入的模組會留在 sys.modules，所以這裡的編譯只在行程啟動時做一次
+from numba import njit, types, float64, int8
+
+# 輸入的 High/Low/Close 只讀不寫，pandas 回傳的唯讀陣列可直接傳入，不必複製
+float64_ro = types.Array(float64, 1, 'C', readonly=True)
+# 尾端狀態 (最後的 SAR, 趨勢, AF, EP)，足以從最後一根 K 線繼續往後算
+sar_state = types.Tuple((float64, int8, float64, float64))
+
+@njit(
+    sar_state(float64_ro, float64_ro, float64_ro,
+              float64[::1], int8[::1],
+              float64, int8, float64, float64,
+              float64, float64),
+    cache=True, fastmath=True, boundscheck=False, error_model='numpy',
+)
+def _sar_extend(high, low, close, sar, trend,
+                sar_cur, trend_cur, af_cur, ep_cur, af_start, af_limit):
+    # 從上一根的狀態接著算 high/low/close 這幾根，結果寫入 sar/trend
+    # 迴圈內只做純量運算 (不呼叫 NumPy、不產生暫存陣列)，讓 Numba 編成最緊湊的機器碼
+    for i in range(high.shape[0]):
+        h = high[i]
+        l = low[i]
+        c = close[i]
+
+        # 基礎 SAR 計算
+        current_sar = sar_cur + af_cur * (ep_cur - sar_cur)
+        
+        new_trend = trend_cur
+        new_af = af_cur
+        new_ep = ep_cur
+
+        if trend_cur == 1:  # 上升趨勢
+            if l <= current_sar: # 判斷最低價是否觸碰
+                if c > current_sar:
+                    # 改良點：觸碰但收盤有守住 -> Reset AF
+                    new_af = af_start
+                else:
+                    # 實體跌破 -> 反轉
+                    new_trend = -1
+                    current_sar = ep_cur
+                    new_af = af_start
+                    new_ep = l
+        else:  # 下降趨勢
+            if h >= current_sar: # 判斷最高價是否觸碰
+                if c < current_sar:
+                    # 改良點：觸碰但收盤沒過 -> Reset AF
+                    new_af = af_start
+                else:
+                    # 實體突破 -> 反轉
+                    new_trend = 1
+                    current_sar = ep_cur
+                    new_af = af_start
+                    new_ep = h
+
+        # 更新極值 (EP) 與 AF (合併成單一判斷，減少分支)
+        cand = h if new_trend == 1 else l
+        better = (new_trend == 1 and cand > new_ep) or (new_trend == -1 and cand < new_ep)
+        if better:
+            new_ep = cand
+            new_af = min(af_limit, new_af + af_start)
+
+        sar[i] = current_sar
+        trend[i] = new_trend
+        sar_cur = current_sar
+        trend_cur = new_trend
+        af_cur = new_af
+        ep_cur = new_ep
+
+    return sar_cur, trend_cur, af_cur, ep_cur
+
+@njit(
+    sar_state(float64_ro, float64_ro, float64_ro,
+              float64[::1], int8[::1],
+              float64, float64),
+    cache=True, fastmath=True, boundscheck=False, error_model='numpy',
+)
+def _sar_core(high, low, close, sar, trend, af_start, af_limit):
+    # 逐根 K 線遞迴 (每一步都依賴前一步，無法向量化，交給 Numba 編譯)
+    size = high.shape[0]
+
+    # 初始值設定
+    trend[0] = 1 if close[min(1, size-1)] > close[0] else -1
+    sar[0] = low[0] if trend[0] == 1 else high[0]
+    # AF 與 EP 只需保留上一步的值，不必存整條陣列
+    af_cur = af_start
+    ep_cur = high[0] if trend[0] == 1 else low[0]
+
+    return _sar_extend(high[1:], low[1:], close[1:], sar[1:], trend[1:],
+                       sar[0], trend[0], af_cur, ep_cur, af_start, af_limit)